@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
 
 from flask import Flask, request, Response
+from celery import Celery
 from datetime import datetime, timedelta
-import urllib.parse as urlparse
-import json
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import hashlib
+import base64
+import functools
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import re
+import os
 import sys
-import pickle
-import fcntl
+import time
+import redis
 
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+logging.basicConfig(stream=sys.stdout, level=os.environ.get('LOG_LEVEL', 'DEBUG'))
 
 app = Flask(__name__)
 
@@ -24,13 +30,68 @@ SUBSCRIPTION_CALLBACK_URL = 'https://<app_name>.azurewebsites.net'
 # Advanced Configuration
 SUBSCRIPTION_CALLBACK_PATH = 'handle_subscription_callback'
 GRAPH_API_URL = 'https://graph.microsoft.com'
-GLOBAL_STATE_PATH = 'globalstate.pkl'
+# Shared state lives in Redis, so that all workers see the same integrations
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+REDIS_KEY_PREFIX = 'mw:'
 # Resubscribe and do a full calendar sync every 23h
 HOURS_BETWEEN_FULLSYNC_AND_RESCUBSCRIBE = 23
+# Seconds a full sync holds its lock, so that a crashed sync doesn't block
+# the integration for good. Longer syncs may overlap with the next one.
+FULLSYNC_LOCK_SECONDS = 600
 # Make subscriptions last for 24h
 HOURS_TO_SUBSCRIBE = 24
 # Get upto the next 8 days, so we always have 7 days in the cache
 CALENDAR_DAYS_TO_CACHE = 8
+# Keep the users of a tenant across syncs for up to 7 days, so that a sync
+# only needs to fetch the users that changed since
+USERS_CACHE_DAYS = 7
+# Connect and read timeout in seconds for passed-through requests, so a
+# stuck SoR call can't hold on to a worker connection
+PASS_THROUGH_TIMEOUT = (10, 60)
+# Number of concurrent SoR calls when fanning out over users or subscriptions
+GRAPH_MAX_WORKERS = 16
+# The SoR accepts at most 20 requests per $batch call
+GRAPH_BATCH_SIZE = 20
+# Fields of emails (messages) and calendar events that get passed on to the cache
+MESSAGE_SELECT = "$select=id,subject,from,toRecipients,importance,sentDateTime,webLink,isRead"
+EVENT_SELECT = ("$select=id,subject,location,organizer,start,end,weblink,responsestatus,"
+                "body,attendees,isCancelled")
+# State entry of the webhook and the fields to fetch, by subscription type
+SUBSCRIPTION_TYPES = {'messages': ('email_webhook', MESSAGE_SELECT),
+                      'events': ('calendar_webhook', EVENT_SELECT)}
+# Records PUT to a Microapps webhook listener at once, as a JSON array.
+# Set to 1, to PUT every record on its own.
+WEBHOOK_BATCH_SIZE = 50
+
+# Events from a day ago up to the cached days ahead are passed on to the cache
+ONE_DAY = timedelta(days=1)
+CALENDAR_CACHE_WINDOW = timedelta(days=CALENDAR_DAYS_TO_CACHE)
+
+rds = redis.Redis.from_url(REDIS_URL)
+
+# Subscription callbacks are processed by a Celery worker, run it with
+# celery -A application worker
+celery = Celery(__name__, broker=REDIS_URL)
+
+# Bodies are serialized with orjson, so requests needs to be told they're JSON
+JSON_HEADERS = {'Content-Type': 'application/json'}
+BASE_HEADERS = {'Accept': 'application/json', **JSON_HEADERS}
+
+# Constant reply of the trigger, encoded once. Flask modifies the Response
+# objects it returns, so those are still created per request.
+STATUS_OK_BODY = b'{"status": "ok"}'
+
+# All outgoing calls share one Session, so connections to the SoR and the
+# webhooks are kept alive rather than paying a TLS handshake per call.
+# Retry transient failures with backoff. POST isn't idempotent, so a
+# failed subscription is left to the next sync rather than duplicated.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=10, pool_maxsize=50,
+    max_retries=Retry(total=5, backoff_factor=0.3,
+                      status_forcelist=[429, 502, 503, 504],
+                      allowed_methods=frozenset(['GET', 'PUT', 'DELETE']),
+                      raise_on_status=False)))
 
 
 class MiddlewareException(Exception):
@@ -40,48 +101,37 @@ class MiddlewareException(Exception):
 
 
 def debugging_decorator(func):
+    # Without debug logging, don't add a call frame to every decorated function
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return func
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        logging.debug("starting " + func.__name__)
+        logging.debug("starting %s", func.__name__)
         return func(*args, **kwargs)
     return wrapper
 
 
 @debugging_decorator
 def store_data(hkey, state):
-    # ToDo: need to wipe old entries on some point, as it will eventually run out of memory
-    data = {}
-    try:
-        with open(GLOBAL_STATE_PATH, 'rb+') as gs_file:
-            fcntl.flock(gs_file, fcntl.LOCK_SH)
-            data = pickle.load(gs_file)
-            fcntl.flock(gs_file, fcntl.LOCK_UN)
-            data[hkey] = state
-    except (FileNotFoundError, IOError):
-        data[hkey] = state
-
+    # Entries expire together with the subscriptions they serve, unless the
+    # next trigger refreshes them
     try:
-        with open(GLOBAL_STATE_PATH, 'wb') as gs_file:
-            fcntl.flock(gs_file, fcntl.LOCK_EX)
-            pickle.dump(data, gs_file)
-            fcntl.flock(gs_file, fcntl.LOCK_UN)
-    except IOError as e:
+        rds.set(REDIS_KEY_PREFIX + hkey, orjson.dumps(state),
+                ex=HOURS_TO_SUBSCRIBE * 3600)
+    except redis.RedisError as e:
         raise MiddlewareException(f"Failed to store MA client state: {e}")
 
 
 @debugging_decorator
 def get_data(hkey):
     try:
-        with open(GLOBAL_STATE_PATH, 'rb') as gs_file:
-            fcntl.flock(gs_file, fcntl.LOCK_SH)
-            data = pickle.load(gs_file)
-            fcntl.flock(gs_file, fcntl.LOCK_UN)
-            return data[hkey]
-    except KeyError as e:
-        raise e
-    except FileNotFoundError:
-        return {}
-    except IOError as e:
-        raise MiddlewareException(f"Failed to open MA client state: {e}")
+        data = rds.get(REDIS_KEY_PREFIX + hkey)
+    except redis.RedisError as e:
+        raise MiddlewareException(f"Failed to read MA client state: {e}")
+    if data is None:
+        raise KeyError(hkey)
+    return orjson.loads(data)
 
 
 @debugging_decorator
@@ -95,99 +145,195 @@ def trigger_middleware():
     # We trust the webhook URLs to form a unique key
     s = (request.args['calendar_webhook']
          + request.args['email_webhook']).encode('utf-8')
-    _hkey = hashlib.sha512(s).hexdigest()
+    _hkey = hashlib.blake2b(s, digest_size=32).hexdigest()
 
     # We split the hkey, so it's not completely contained in the url, that may get logged
     # Yet, we can't put it all into the clientstate, as the SoR restrict the clientstate length.
     hkey = [_hkey[0:32], _hkey[32:]]
 
+    # We store the SoR bearer token, to make APi calls with it later. The
+    # time of the next sync is kept apart, so only a sync ever writes it.
+    state = {'authorization': request.headers.get('Authorization'),
+             'calendar_webhook': request.args.get('calendar_webhook'),
+             'email_webhook': request.args.get('email_webhook')}
+    store_data(_hkey, state)
+
     # Check whether it's time for a sync
-    next_sync = 0
+    # next_sync is kept as a Unix timestamp, which is cheap to compare
+    now = time.time()
+    if now < get_next_sync(_hkey):
+        return Response(STATUS_OK_BODY, status=200, mimetype='application/json')
+
+    # Need to resync - unless another worker is already at it for this
+    # integration, syncs of other integrations are not held up though
+    resync_lock = rds.lock(f"{REDIS_KEY_PREFIX}lock:{_hkey}", timeout=FULLSYNC_LOCK_SECONDS)
+    if resync_lock.acquire(blocking=False):
+        try:
+            # Another worker may have finished a sync since it was checked
+            if now >= get_next_sync(_hkey):
+                resync(hkey, _hkey, state['calendar_webhook'])
+                # Stored before the lock is released, so no other worker
+                # starts over right away
+                store_data(f"next_sync:{_hkey}",
+                           now + HOURS_BETWEEN_FULLSYNC_AND_RESCUBSCRIBE * 3600)
+        finally:
+            try:
+                resync_lock.release()
+            except redis.exceptions.LockError:
+                # The sync outlasted the lock, which doesn't undo the sync
+                logging.warning("Sync of %s took longer than %ss",
+                                hkey, FULLSYNC_LOCK_SECONDS)
+
+    return Response(STATUS_OK_BODY, status=200, mimetype='application/json')
+
+
+@debugging_decorator
+def get_next_sync(_hkey):
     try:
-        state = get_data(_hkey)
-        next_sync = state['next_sync']
+        return get_data(f"next_sync:{_hkey}")
     except KeyError:
-        logging.warning(f"Received unexpected hkey {hkey}")
-
-    bearer_token = request.headers.get('Authorization')
-    calendar_webhook = request.args.get('calendar_webhook')
-    email_webhook = request.args.get('email_webhook')
-    if next_sync == 0 or datetime.now() >= next_sync:
-        # Need to resync
-        headers = get_headers(request)
-        users = get_all_users(headers)
-
-        # We pull the calendar regularly, to avoid having to cache all times,
-        # and to be able to report events planed before the webhook got configured.
-        update_calendar(headers, users, calendar_webhook)
-        wipe_subscriptions(headers)
-        register_subscriptions(headers, hkey, users, calendar_webhook, email_webhook)
-        next_sync = datetime.now()+timedelta(hours=HOURS_BETWEEN_FULLSYNC_AND_RESCUBSCRIBE)
-
-    # We store the SoR bearer token, to make APi calls with it later
-    state = {'authorization': bearer_token,
-             'calendar_webhook': calendar_webhook,
-             'email_webhook': email_webhook,
-             'next_sync': next_sync}
-    store_data(_hkey, state)
+        logging.warning("No sync yet for hkey %s", _hkey)
+        return 0
+
 
-    return Response('{"status": "ok"}', status=200)
+@debugging_decorator
+def resync(hkey, _hkey, calendar_webhook):
+    """
+    Sync the calendars and renew the subscriptions of an integration.
+    """
+    headers = get_headers(request)
+    users = get_all_users(headers)
+
+    # We pull the calendar regularly, to avoid having to cache all times,
+    # and to be able to report events planed before the webhook got configured.
+    update_calendar(headers, users, calendar_webhook)
+
+    # Remember what the subscriptions were registered with, so they
+    # can be renewed rather than re-created next time
+    try:
+        registered = get_data(f"subscriptions:{_hkey}")
+    except KeyError:
+        registered = {}
+    registered = register_subscriptions(
+        headers, hkey, users, get_subscription_ids(headers, hkey), registered)
+    store_data(f"subscriptions:{_hkey}", registered)
 
 
 @debugging_decorator
-def wipe_subscriptions(headers):
-    """
-    Wipe pre-existing event subscriptions, to start with a clean slate,
-    and to avoid being notified twice.
-    """
-    subscriptions = odata_get(f"{GRAPH_API_URL}/v1.0/subscriptions/?"
-                              + "select=id,notificationUrl",
-                              headers=headers)
-    if subscriptions is None:
-        raise MiddlewareException("Failed to wipe subscriptions")
-    for subscription in subscriptions:
-        # ToDo: could probably do this using a filter as part of the request
-        if not subscription['notificationUrl'].startswith(SUBSCRIPTION_CALLBACK_URL):
-            continue
-        r = requests.delete(f"{GRAPH_API_URL}/v1.0/subscriptions/"
-                            + f"{subscription['id']}",
-                            headers=headers)
-        if not r.ok:
-            raise MiddlewareException("Failed to delete subscription "
-                                      + f"{subscription['id']} due to "
-                                      + f"{r.status_code}")
+def get_subscription_ids(headers, hkey):
+    """
+    Get the ids of the pre-existing subscriptions that notify this middleware
+    for this integration. Those of other integrations are left alone.
+    """
+    # ToDo: could probably do this using a filter as part of the request
+    return {subscription['id'] for subscription in
+            odata_iter(f"{GRAPH_API_URL}/v1.0/subscriptions/?"
+                       + "select=id,notificationUrl",
+                       headers=headers)
+            if subscription['notificationUrl'].startswith(SUBSCRIPTION_CALLBACK_URL)
+            and subscription['notificationUrl'].endswith("/" + hkey[1])}
 
 
 @debugging_decorator
-def register_subscriptions(headers, hkey, users, calendar_webhook, email_webhook):
+def register_subscriptions(headers, hkey, users, subscription_ids, registered):
     """
-    Register for change events in emails (messages) and calendar (events)
+    Register for change events in emails (messages) and calendar (events).
+    Subscriptions which are still registered as needed only get their
+    expiration extended. All other pre-existing subscriptions are deleted,
+    to avoid being notified twice.
+    Returns the registered subscriptions.
     """
     future = datetime.now()+timedelta(hours=HOURS_TO_SUBSCRIBE)
     untilstring = future.strftime("%Y-%m-%dT%H:%M:%S.0000000Z")
 
+    def user_subscriptions(user):
+        # Only emails of interest get notified, so the SoR does the filtering
+        # rather than us fetching each message just to discard it
+        yield 'events', f"/users/{user['id']}/events"
+        yield 'messages', f"/users/{user['id']}/messages?$filter=importance eq 'high'"
+        if user['manager_mail']:
+            manager_mail = user['manager_mail'].replace("'", "''")
+            yield 'messages', (f"/users/{user['id']}/messages?"
+                               f"$filter=from/emailAddress/address eq '{manager_mail}'")
+
+    def subscribe(user, registration):
+        (notification_url, resource, client_state) = registration
+        data = {
+            "changeType": "created,updated,deleted",
+            "notificationUrl": notification_url,
+            "resource": resource,
+            "expirationDateTime": untilstring,
+            "clientState": client_state
+        }
+        r = SESSION.post(f"{GRAPH_API_URL}/v1.0/subscriptions",
+                         headers=headers, data=orjson.dumps(data))
+        if not r.ok:
+            logging.warning("Unable to subscribe %s for %s: %s",
+                            user['mail'], resource, r.text)
+            return None
+        logging.debug("Subscribed %s to %s", user['mail'], resource)
+        return orjson.loads(r.content)['id']
+
+    # The SoR doesn't tell the clientState of a subscription, so they are
+    # matched by what they were registered with
+    renewable = {tuple(registration): subscription_id
+                 for subscription_id, registration in registered.items()
+                 if subscription_id in subscription_ids}
+    to_renew = []
+    to_create = []
     for user in users:
-        if user['mail'] is None:
-            continue
-        for subscription in ['messages', 'events']:
-            data = {
-                "changeType": "created,updated,deleted",
-                "notificationUrl": (SUBSCRIPTION_CALLBACK_URL + "/" +
-                                    SUBSCRIPTION_CALLBACK_PATH + "/" +
-                                    subscription + "/" + hkey[1]),
-                "resource": f"/users/{user['id']}/{subscription}",
-                "expirationDateTime": untilstring,
+        for subscription, resource in user_subscriptions(user):
+            registration = (
+                (SUBSCRIPTION_CALLBACK_URL + "/" + SUBSCRIPTION_CALLBACK_PATH + "/" +
+                 subscription + "/" + hkey[1]),
+                resource,
                 # Store some metadata in the clientState, to be able to
                 # asociate the request later.
-                "clientState": (hkey[0] + "^" + user['mail'] + "^" + user['manager_mail'])
-            }
-            r = requests.post(f"{GRAPH_API_URL}/v1.0/subscriptions",
-                              headers=headers, data=json.dumps(data))
-            if not r.ok:
-                logging.warning(f"Unable to subscribe {user['mail']} for "
-                                f"{subscription}: {r.text}")
+                hkey[0] + "^" + user['mail'] + "^" + user['manager_mail'])
+            if registration in renewable:
+                to_renew.append((user, registration, renewable.pop(registration)))
             else:
-                logging.debug(f"Subscribed {user['mail']} to {subscription}")
+                to_create.append((user, registration))
+
+    new_registered = {}
+    responses = graph_batch(headers, [
+        {'id': str(idx), 'method': 'PATCH', 'url': f"/subscriptions/{subscription_id}",
+         'headers': JSON_HEADERS, 'body': {'expirationDateTime': untilstring}}
+        for idx, (_, _, subscription_id) in enumerate(to_renew)])
+    for idx, (user, registration, subscription_id) in enumerate(to_renew):
+        status = responses.get(str(idx), {}).get('status')
+        if status == 404:
+            # It expired in the meantime
+            to_create.append((user, registration))
+        else:
+            # On any other failure, e.g. throttling, the subscription is kept.
+            # It lasts past the next sync, which renews it.
+            if status != 200:
+                logging.warning("Failed to renew subscription %s: %s",
+                                subscription_id, status)
+            new_registered[subscription_id] = registration
+
+    with ThreadPoolExecutor(max_workers=GRAPH_MAX_WORKERS) as executor:
+        futures = [(executor.submit(subscribe, user, registration), registration)
+                   for user, registration in to_create]
+        for future, registration in futures:
+            subscription_id = future.result()
+            if subscription_id is not None:
+                new_registered[subscription_id] = registration
+
+    stale = [subscription_id for subscription_id in subscription_ids
+             if subscription_id not in new_registered]
+    responses = graph_batch(headers, [
+        {'id': str(idx), 'method': 'DELETE', 'url': f"/subscriptions/{subscription_id}"}
+        for idx, subscription_id in enumerate(stale)])
+    for idx, subscription_id in enumerate(stale):
+        status = responses.get(str(idx), {}).get('status')
+        # Subscriptions may have expired in the meantime
+        if status not in (204, 404):
+            raise MiddlewareException("Failed to delete subscription "
+                                      + f"{subscription_id} due to "
+                                      + f"{status}")
+    return new_registered
 
 
 @debugging_decorator
@@ -197,122 +343,113 @@ def handle_subscription_callback(subscription, hkey1):
     This is where we get event callbacks from O365
     """
 
+    if subscription not in SUBSCRIPTION_TYPES:
+        logging.warning("Ignoring callback for unknown subscription %s", subscription)
+        return Response(status=404)
+
     # Do the O365 webhook validation dance
     if 'validationToken' in request.args:
         logging.debug("Returning validationToken")
         return Response(request.args['validationToken'], status=200,
                         mimetype='text/plain; charset=utf-8')
 
-    # More than one event can come in a single callback
-    jsonbody = json.loads(request.data)
-    for value in jsonbody['value']:
-        try:
-            _handle_subscription_callback_value(subscription, hkey1, value)
-        except MiddlewareException:
-            # This is a rather common path, e.g. during event deletion,
-            # there is an update followed directly by delete, so we'd
-            # race trying to get the update.
-            pass
+    # More than one event can come in a single callback. The values are
+    # handed over to the worker, so O365 isn't kept waiting on the SoR.
+    jsonbody = orjson.loads(request.data)
+    handle_subscription_callback_values.delay(subscription, hkey1, jsonbody['value'])
 
     # O365 expects a 202 return code and will otherwise keep resending.
-    return Response('', status=202)
+    return Response(status=202)
 
 
+@celery.task(bind=True, ignore_result=True, max_retries=5)
 @debugging_decorator
-def _handle_subscription_callback_value(subscription, hkey1, value):
-
-    # Decode the metadata which we placed before
-    client_state = value['clientState']
-    (hkey0, mail, manager_mail) = client_state.split('^')
+def handle_subscription_callback_values(self, subscription, hkey1, values):
+    """
+    Process the values of a subscription callback. The data of new and
+    changed items is fetched from the SoR with $batch, rather than one
+    request per item, and put into the cache in batches as well. Failing to
+    resolve a single item is rather common, e.g. during event deletion there
+    is an update followed directly by delete, so we race trying to get the
+    update - such items are skipped. Throttled items and other failures
+    are retried with backoff, without the values already taken care of.
+    """
+    (webhook, select) = SUBSCRIPTION_TYPES[subscription]
 
-    # hleu is split between url and client_state - put it back together
-    hkey = hkey0+hkey1
+    # The hkey is split between url and client_state - put it back together
+    values_by_hkey = {}
+    for value in values:
+        hkey0 = value['clientState'].split('^', 1)[0]
+        values_by_hkey.setdefault(hkey0 + hkey1, []).append(value)
 
-    try:
-        globalstateentry = get_data(hkey)
-        if not any(globalstateentry):
-            raise MiddlewareException(f"{GLOBAL_STATE_PATH} is empty "
-                                      + "at point of receiving webhook callback")
-    except KeyError:
-        logging.warning(f"Received unexpected hkey {hkey}")
-
-        # Still return to 202 to avoid O365 hitting us with the same callback
-        return Response('', status=202)
+    now = datetime.now()
+    unresolved = []
+    for hkey, hkey_values in values_by_hkey.items():
+        try:
+            globalstateentry = get_data(hkey)
+            if not any(globalstateentry):
+                raise MiddlewareException("MA client state is empty "
+                                          + "at point of receiving webhook callback")
+        except KeyError:
+            logging.warning("Received unexpected hkey %s", hkey)
+            continue
+        except MiddlewareException:
+            unresolved.extend(hkey_values)
+            continue
 
-    odata_id = value['resourceData']['@odata.id']
-    shortid = odata_id.rsplit('/', 1)[1]
+        fetches = []
+        for value in hkey_values:
+            # Decode the metadata which we placed before
+            (_, mail, manager_mail) = value['clientState'].split('^')
+            odata_id = value['resourceData']['@odata.id']
+            if value['changeType'] == 'deleted':
+                # Item deleted, so we remove the cache entry
+                shortid = odata_id.rsplit('/', 1)[1]
+                SESSION.delete(f"{globalstateentry[webhook]}/?id={shortid}")
+            else:
+                # Item new or changed, so we need to get the real data
+                fetches.append((mail, manager_mail, odata_id, value))
+
+        headers = get_authorization_headers(globalstateentry['authorization'])
+        responses = graph_batch(headers, [
+            {'id': str(idx), 'method': 'GET', 'url': f"/{odata_id}?{select}"}
+            for idx, (_, _, odata_id, _) in enumerate(fetches)])
+        records = []
+        for idx, (mail, manager_mail, odata_id, value) in enumerate(fetches):
+            response = responses.get(str(idx))
+            if response is None or response['status'] == 429 or response['status'] >= 500:
+                unresolved.append(value)
+            elif response['status'] != 200:
+                logging.warning("Failed to resolve %s: %s", odata_id, response['status'])
+            elif subscription == 'messages':
+                records.append(parse_message(response['body'], mail, manager_mail))
+            else:
+                event = parse_event(response['body'], mail, now - ONE_DAY,
+                                    now + CALENDAR_CACHE_WINDOW)
+                if event is not None:
+                    records.append(event)
+        put_to_webhook(globalstateentry[webhook], records)
 
-    if subscription == 'messages':
-        if value['changeType'] == 'deleted':
-            # Message deleted, so we remove the cache entry
-            requests.delete(
-                f"{globalstateentry['email_webhook']}/?id={shortid}")
-        else:
-            # Message new or changed, so we update the cache
-            process_message(globalstateentry, mail, manager_mail, odata_id)
-    elif subscription == 'events':
-        if value['changeType'] == 'deleted':
-            # Event deleted, so we remove the cache entry
-            requests.delete(
-                f"{globalstateentry['calendar_webhook']}/?id={shortid}")
-        else:
-            # Event changed, so we update the cache
-            process_event(globalstateentry, mail, odata_id)
-    else:
-        raise MiddlewareException("Unknown subscription type")
+    if unresolved:
+        # Only the unresolved values are retried, with exponential backoff
+        raise self.retry(args=(subscription, hkey1, unresolved),
+                         exc=MiddlewareException(f"Failed to resolve {len(unresolved)} values"),
+                         countdown=2 ** self.request.retries)
 
 
 @debugging_decorator
-def process_message(globalstateentry, mail, manager_mail, odata_id):
+def parse_message(message, owner, manager_mail):
     """
-    Handle email, first of all - we need to get the real data
+    Prepare an email for the cache
     """
-    headers = {
-        'Authorization': globalstateentry['authorization'],
-        'Content-type': 'application/json'
-    }
-    jsondata = odata_getone(f"{GRAPH_API_URL}/v1.0/{odata_id}?"
-                            + "$select=id,subject,from,toRecipients,"
-                            + "importance,sentDateTime,webLink,isRead",
-                            headers=headers)
-    if not jsondata:
-        raise MiddlewareException(
-            f"Failed to resolve message in process_message {odata_id}")
+    # The subscriptions only notify about high importance emails and those
+    # from the manager, so there is nothing left to filter here
     is_from_manager = (
-        manager_mail == jsondata['from']['emailAddress']['address'].lower())
-
-    # Filter the data to avoid spaming the cache
-    if not is_from_manager and jsondata['importance'] != 'high':
-        return
-    jsondata.update({'owner': mail,
-                     'is_from_manager': is_from_manager})
-
-    logging.debug(f"Inserting email {jsondata['id']} into cache via webhook")
-    r = requests.put(
-        globalstateentry['email_webhook'], data=json.dumps(jsondata))
-    if not r.ok:
-        logging.warning(
-            f"Failed to put to {globalstateentry['email_webhook']}: {r.text}")
-
-
-@debugging_decorator
-def process_event(globalstateentry, mail, odata_id):
-    """
-    Handle calendar event, first of all - we need to get the real data
-    """
-    headers = {
-        'Authorization': globalstateentry['authorization'],
-        'Content-type': 'application/json'
-    }
-    jsondata = odata_getone(f"{GRAPH_API_URL}/v1.0/{odata_id}?"
-                            + "$select=id,subject,location,organizer,start,"
-                            + "end,weblink,responsestatus,body,attendees,"
-                            + "isCancelled",
-                            headers=headers)
-    if not jsondata:
-        raise MiddlewareException(
-            f"Failed to resolve event in process_event {odata_id}")
-    parse_event(jsondata, mail, globalstateentry['calendar_webhook'])
+        manager_mail == message['from']['emailAddress']['address'].lower())
+    message.update({'owner': owner,
+                    'is_from_manager': is_from_manager})
+    logging.debug("Inserting email %s into cache via webhook", message['id'])
+    return message
 
 
 @debugging_decorator
@@ -323,43 +460,55 @@ def update_calendar(headers, users, calendar_webhook):
     """
     startdatetime = datetime.now()
     startdatetime_iso = startdatetime.isoformat()
-    enddatetime = startdatetime + timedelta(days=CALENDAR_DAYS_TO_CACHE)
+    enddatetime = startdatetime + CALENDAR_CACHE_WINDOW
     enddatetime_iso = enddatetime.isoformat()
-    for user in users:
-        events = odata_get("https://graph.microsoft.com/v1.0/"
-                           + f"users/{user['id']}/calendarview?"
-                           + "startdatetime="+startdatetime_iso
-                           + "&enddatetime="+enddatetime_iso
-                           + "&select=id,subject,location,organizer,start,"
-                           + "end,weblink,responsestatus,body,attendees,"
-                           + "isCancelled",
-                           headers=headers)
-        if events is None:
-            logging.error("Failed to get events user user {user['id']}")
-            continue
-        logging.debug('Got %d events' % (len(events)))
+    lower_bound = startdatetime - ONE_DAY
+
+    def update_user_calendar(user):
+        # Events are processed while the next page is being fetched
+        events = odata_iter("https://graph.microsoft.com/v1.0/"
+                            + f"users/{user['id']}/calendarview?"
+                            + "startdatetime="+startdatetime_iso
+                            + "&enddatetime="+enddatetime_iso
+                            + "&" + EVENT_SELECT,
+                            headers=headers)
+        count = 0
+        parsed_events = []
         for event in events:
-            parse_event(event, user['mail'], calendar_webhook)
+            count += 1
+            event = parse_event(event, user['mail'], lower_bound, enddatetime)
+            if event is None:
+                continue
+            parsed_events.append(event)
+            if len(parsed_events) >= WEBHOOK_BATCH_SIZE:
+                put_to_webhook(calendar_webhook, parsed_events)
+                parsed_events = []
+        put_to_webhook(calendar_webhook, parsed_events)
+        logging.debug('Got %d events', count)
+
+    with ThreadPoolExecutor(max_workers=GRAPH_MAX_WORKERS) as executor:
+        # Consume the results, to raise the first failure
+        list(executor.map(update_user_calendar, users))
 
 
 @debugging_decorator
-def parse_event(event, owner, calendar_webhook):
-    # Filter the data, to avoid spaming the cache
-    eventdt = datetime.strptime(event['start']['dateTime'].split('.', 1)[0],
-                                '%Y-%m-%dT%H:%M:%S')
-    if (eventdt < datetime.now() - timedelta(days=1)
-            or eventdt > datetime.now() + timedelta(days=CALENDAR_DAYS_TO_CACHE)):
-        return
+def parse_event(event, owner, lower_bound, upper_bound):
+    """
+    Prepare an event for the cache, returns None if it should be left out
+    """
+    # Filter the data, to avoid spaming the cache. The bounds are computed
+    # once by the caller, rather than for every event.
+    eventdt = datetime.fromisoformat(event['start']['dateTime'][:19])
+    if eventdt < lower_bound or eventdt > upper_bound:
+        return None
 
     # ToDo: could probably just pass-through the event - but would need
     # to rebuild apps for that
     meeting_link = extract_meetinglink(
         event['location']['displayName']+'^'+event['body']['content'])
     event.update({'owner': owner, 'meetingLink': meeting_link})
-    logging.debug(f"Inserting event {event['id']} into cache via webhook")
-    r = requests.put(calendar_webhook, data=json.dumps(event))
-    if not r.ok:
-        logging.warning(f"Failed to put to {calendar_webhook}: {r.text}")
+    logging.debug("Inserting event %s into cache via webhook", event['id'])
+    return event
 
 
 @debugging_decorator
@@ -373,20 +522,30 @@ def pass_through(path):
     if ((len(pathsplit) < 2
          or pathsplit[0] not in ['v1.0', 'beta']
          or request.headers.get('Authorization') is None)):
-        logging.warning(f"Ignoring unknown forwarding request for {path}")
+        logging.warning("Ignoring unknown forwarding request for %s", path)
         return Response('{}'.format(request.headers.get('Authorization')), status=503)
     headers = get_headers(request)
-    r = requests.request(
+    r = SESSION.request(
             request.method,
             f'{GRAPH_API_URL}/{path}',
             data=request.data,
             params=request.args,
-            headers=headers
+            headers=headers,
+            stream=True,
+            timeout=PASS_THROUGH_TIMEOUT
         )
     if not r.ok or r.status_code < 200 or r.status_code > 299:
-        logging.warning(f"Failed pass-through of {request.method} to {path} with {r.status_code} "
-                        + f"due to {r.text}")
-    return Response(r.content, status=r.status_code)
+        logging.warning("Failed pass-through of %s to %s with %s due to %s",
+                        request.method, path, r.status_code, r.text)
+    # Stream the body through, rather than buffering it all first. It is
+    # decompressed on the way, so Content-Length/-Encoding don't apply anymore.
+    passed_headers = {k: v for k, v in r.headers.items()
+                      if k.lower() in ('content-type', 'etag')}
+    resp = Response(r.iter_content(chunk_size=65536), status=r.status_code,
+                    headers=passed_headers)
+    # Hand the connection back to the pool, even if the client disconnects early
+    resp.call_on_close(r.close)
+    return resp
 
 ###################
 # Utility functions
@@ -395,40 +554,177 @@ def pass_through(path):
 
 @debugging_decorator
 def get_all_users(headers):
-    users = odata_get(f"{GRAPH_API_URL}/v1.0/users",
-                      headers=headers)
-    if users is None:
-        raise MiddlewareException("Failed to get users")
+    """
+    Get all users that have a mail, along with their manager's mail. The
+    users are cached for each tenant and brought up to date with a delta
+    query, so only users that changed since the last sync need their
+    manager looked up.
+    """
+    cache_key = get_users_cache_key(headers['Authorization'])
+    users_cache = None
+    try:
+        cached = rds.get(cache_key)
+        if cached is not None:
+            users_cache = orjson.loads(cached)
+    except redis.RedisError as e:
+        logging.warning("Failed to read users cache: %s", e)
+
+    changes = None
+    if users_cache and users_cache.get('deltaLink'):
+        users_by_id = {user['id']: user for user in users_cache['users']}
+        (changes, delta_link) = get_users_delta(users_cache['deltaLink'], headers)
+    if changes is None:
+        # Nothing cached, or the deltaLink is no longer valid - start over.
+        # Selecting the manager makes manager changes show up in the delta.
+        users_by_id = {}
+        (changes, delta_link) = get_users_delta(
+            f"{GRAPH_API_URL}/v1.0/users/delta?$select=id,mail,manager", headers)
+        if changes is None:
+            raise MiddlewareException("Failed to get users")
+
+    changed_mails = set()
+    for change in changes:
+        if '@removed' in change:
+            user = users_by_id.pop(change['id'], None)
+            if user and user['mail']:
+                changed_mails.add(user['mail'].lower())
+            continue
+        # Changed users only come with their changed properties, their
+        # manager gets looked up again
+        user = users_by_id.setdefault(change['id'], {'mail': None})
+        old_mail = user['mail']
+        user.update({k: v for k, v in change.items() if '@' not in k})
+        user.pop('manager_mail', None)
+        if old_mail and old_mail != user['mail']:
+            changed_mails.add(old_mail.lower())
+    all_users = list(users_by_id.values())
+
+    # Subordinates of managers whose mail changed need their manager_mail
+    # looked up again as well
+    for user in all_users:
+        if user.get('manager_mail') in changed_mails:
+            del user['manager_mail']
+    # Users without a mail, e.g. rooms or service accounts, have nothing to
+    # sync - they are only kept in the cache, for the delta to apply to.
+    # Users without a manager_mail are unresolved, either changed or their
+    # lookup failed before.
+    set_manager_mails(headers, [user for user in all_users
+                                if user['mail'] and 'manager_mail' not in user])
+
+    # An empty list may as well be a failed fetch, so only cache actual users
+    if all_users:
+        try:
+            rds.set(cache_key, orjson.dumps({'deltaLink': delta_link, 'users': all_users}),
+                    ex=USERS_CACHE_DAYS * 24 * 3600)
+        except redis.RedisError as e:
+            logging.warning("Failed to store users cache: %s", e)
+    # Users still unresolved are synced without their manager for now
+    return [{'manager_mail': '', **user} for user in all_users if user['mail']]
 
-    # ToDo: Finding every users manager with a separate API call, sounds
-    # expensive. Is there a better way?
+
+@debugging_decorator
+def get_users_delta(url, headers):
+    """
+    Follow a users delta query through all its pages. Returns the changes
+    along with the deltaLink for the next query, or None for both on failure.
+    """
+    changes = []
+    while True:
+        rjson = odata_getone(url, headers)
+        if not rjson:
+            return (None, None)
+        changes.extend(rjson['value'])
+        if '@odata.nextLink' not in rjson:
+            return (changes, rjson.get('@odata.deltaLink'))
+        url = rjson['@odata.nextLink']
+
+
+@debugging_decorator
+def set_manager_mails(headers, users):
+    # Users without a manager get a 404, which leaves their manager_mail empty.
+    # On any other failure, manager_mail isn't set, so the next sync retries.
+    responses = graph_batch(headers, [
+        {'id': str(idx), 'method': 'GET',
+         'url': f"/users/{user['id']}/manager?$select=mail"}
+        for idx, user in enumerate(users)])
     for idx, user in enumerate(users):
-        manager = odata_getone(f"{GRAPH_API_URL}/v1.0/users/{user['id']}/"
-                               + "manager?$select=mail",
-                               headers=headers)
-        if manager and 'mail' in manager:
-            users[idx]['manager_mail'] = manager['mail'].lower()
-        else:
-            users[idx]['manager_mail'] = ''
-    return users
+        response = responses.get(str(idx), {})
+        if response.get('status') == 200:
+            user['manager_mail'] = (response['body'].get('mail') or '').lower()
+        elif response.get('status') == 404:
+            user['manager_mail'] = ''
+
+
+def get_users_cache_key(authorization):
+    """
+    Bearer tokens get renewed regularly, so the users are cached by the
+    tenant id claim of the token. Fall back to the token itself, if it
+    can't be decoded.
+    """
+    try:
+        payload = authorization.split(' ', 1)[1].split('.')[1]
+        claims = orjson.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        tenant = claims['tid']
+    except (IndexError, KeyError, TypeError, ValueError):
+        tenant = hashlib.blake2b(authorization.encode('utf-8'), digest_size=16).hexdigest()
+    return f"{REDIS_KEY_PREFIX}users:{tenant}"
 
 
 @debugging_decorator
-def odata_get(url, headers):
+def graph_batch(headers, batch_requests):
     """
-    Get a list from odata. Follow nextLink where needed.
+    Send requests to the SoR through $batch, GRAPH_BATCH_SIZE at a time.
+    Returns the responses keyed by request id, ids of failed batches are missing.
     """
-    all_values = list()
-    while url:
+    def send_batch(batch):
+        r = SESSION.post(f"{GRAPH_API_URL}/v1.0/$batch",
+                         headers=headers, data=orjson.dumps({'requests': batch}))
+        if not r.ok:
+            logging.warning("Batch request hit %s: %s", r.status_code, r.text)
+            return []
+        return orjson.loads(r.content)['responses']
+
+    batches = [batch_requests[i:i + GRAPH_BATCH_SIZE]
+               for i in range(0, len(batch_requests), GRAPH_BATCH_SIZE)]
+    responses = {}
+    with ThreadPoolExecutor(max_workers=GRAPH_MAX_WORKERS) as executor:
+        for batch_responses in executor.map(send_batch, batches):
+            for response in batch_responses:
+                if response['status'] not in (200, 204, 404):
+                    logging.warning("Batched request %s hit %s",
+                                    response['id'], response['status'])
+                responses[response['id']] = response
+    return responses
+
+
+@debugging_decorator
+def put_to_webhook(webhook, records):
+    """
+    Insert records into the cache, WEBHOOK_BATCH_SIZE at a time. A single
+    record is sent on its own, more go as an array.
+    """
+    for i in range(0, len(records), WEBHOOK_BATCH_SIZE):
+        batch = records[i:i + WEBHOOK_BATCH_SIZE]
+        r = SESSION.put(webhook, data=orjson.dumps(batch if len(batch) > 1 else batch[0]),
+                        headers=JSON_HEADERS)
+        if not r.ok:
+            logging.warning("Failed to put to %s: %s", webhook, r.text)
+
+
+@debugging_decorator
+def odata_iter(url, headers):
+    """
+    Iterate over a list from odata. Follow nextLink where needed, fetching
+    the next page in the background while the current one is consumed.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
         rjson = odata_getone(url, headers)
-        url = None
-        if rjson:
-            all_values.extend(rjson['value'])
-            try:
-                url = rjson['@odata.nextLink']
-            except KeyError:
-                pass
-    return all_values
+        while rjson:
+            next_page = None
+            if '@odata.nextLink' in rjson:
+                next_page = executor.submit(odata_getone, rjson['@odata.nextLink'], headers)
+            yield from rjson['value']
+            rjson = next_page.result() if next_page else None
 
 
 @debugging_decorator
@@ -436,28 +732,46 @@ def odata_getone(url, headers):
     """
     Get a single object from Odata
     """
-    r = requests.get(url, headers=headers)
+    r = SESSION.get(url, headers=headers)
     if not r.ok:
-        logging.warning(f"Fetch url {url} hit {r.status_code}")
+        logging.warning("Fetch url %s hit %s", url, r.status_code)
         return None
-    rjson = r.json()
+    rjson = orjson.loads(r.content)
     if 'error' in rjson:
-        logging.warning(f"Fetching of {url} returned error {r.text}")
+        logging.warning("Fetching of %s returned error %s", url, r.text)
         return None
     return rjson
 
 
+# Matches a URL, with its netloc as the first group
+MEETING_URL_RE = re.compile(r'https://([^/?#\s]*)\S*')
+MEETING_HOSTS = frozenset(["gotomeet.me", "www.gotomeet.me", "global.gotomeeting.com",
+                           "teams.microsoft.com"])
+MEETING_HOST_SUFFIXES = (".webex.com",)
+# Most texts contain no meeting link at all, which a substring scan rules
+# out quicker than the URL pattern
+MEETING_HOST_MARKERS = tuple(MEETING_HOSTS) + MEETING_HOST_SUFFIXES
+
+
 @debugging_decorator
 def extract_meetinglink(astring):
-    meetinglink = None
-    urls = re.findall(r'(https://\S+)', astring)
-    for url in urls:
-        urlp = urlparse.urlparse(url)
-        if ((urlp.netloc in ["gotomeet.me", "www.gotomeet.me", "global.gotomeeting.com", "teams.microsoft.com"]
-             or urlp.netloc.endswith(".webex.com"))):
-            meetinglink = url
-            break
-    return meetinglink
+    if not any(marker in astring for marker in MEETING_HOST_MARKERS):
+        return None
+    for match in MEETING_URL_RE.finditer(astring):
+        netloc = match.group(1)
+        if netloc in MEETING_HOSTS or netloc.endswith(MEETING_HOST_SUFFIXES):
+            return match.group(0)
+    return None
+
+
+@functools.lru_cache(maxsize=16)
+def get_authorization_headers(authorization):
+    """
+    Headers for calling the SoR with a bearer token. The SoR only speaks
+    JSON, so the token is all that differs. The dict is shared between
+    calls with the same token and must not be modified.
+    """
+    return {**BASE_HEADERS, 'Authorization': authorization}
 
 
 @debugging_decorator
@@ -467,11 +781,7 @@ def get_headers(request):
     Azure API gateway adds extra ones that invlidate forwarded requests
     this function pics and chooses the header values that are needed
     """
-    return {
-        'Authorization': request.headers['Authorization'],
-        'Accept': request.headers['Accept'],
-        'Content-Type': request.headers['Content-Type']
-    }
+    return get_authorization_headers(request.headers['Authorization'])
 
 
 if __name__ == "__main__":
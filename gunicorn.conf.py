@@ -0,0 +1,12 @@
+# gunicorn picks this up from the working directory, e.g.
+# gunicorn --bind=0.0.0.0 application:app
+import multiprocessing
+
+# The middleware mostly waits on the SoR and the webhooks, so each worker
+# serves many requests at once using gevent
+worker_class = 'gevent'
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_connections = 1000
+keepalive = 30
+# A full sync of a large tenant can take a while
+timeout = 600